@@ -1,4 +1,4 @@
-import multiprocessing, glob, shutil, os, datetime, subprocess, math
+import multiprocessing, glob, shutil, os, datetime, subprocess, math, functools, tempfile, itertools, warnings
 
 import geopandas as gpd
 import pandas as pd
@@ -30,9 +30,13 @@ import cameratransform as ct
 from rasterio.merge import merge
 
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from contextlib import ExitStack
 from pyproj import CRS
 from rasterio.transform import Affine
 from rasterio.enums import Resampling
+from rasterio.windows import Window
 
 
 def write_metadata_csv(img_set, csv_output_path):
@@ -121,11 +125,14 @@ def load_images(img_list):
     Output: A multidimensional numpy array of all image captures in a directory 
     
     """
-    all_imgs = []
-    for im in img_list:
+    # the images are read straight into one preallocated array, shaped after the first image, instead of being stacked from a list
+    all_imgs = np.array([])
+    for i, im in enumerate(img_list):
         with rasterio.open(im, 'r') as src:
-            all_imgs.append(src.read())
-    return(np.array(all_imgs))
+            if i == 0:
+                all_imgs = np.empty((len(img_list), src.count, src.height, src.width), dtype = src.dtypes[0])
+            src.read(out = all_imgs[i])
+    return(all_imgs)
 
 def load_img_fn_and_meta(csv_path, count=10000, start=0):
     """
@@ -294,6 +301,83 @@ def process_micasense_images(project_dir, warp_img_dir=None, overwrite=False, sk
     return(outputPath)
 
 
+def _map_images(func, *iterables, progress = True):
+    """
+    This function applies func to every item of the iterables on a pool of threads, since rasterio and numpy release the GIL, and yields the results in order. At most two items per thread are in flight, so large results are not all held in memory. GDAL threads are split among the threads, and every call runs in its own rasterio environment since environments are per thread.
+
+    Inputs:
+    func: A function called as func(*items, num_threads = num_threads) on every item, where num_threads is the number of GDAL threads of the call
+    iterables: One iterable per positional argument of func, usually the image filepaths
+    progress: Option to show a progress bar. Default is True.
+
+    Output: A generator of the results of func, in the order of the items
+    """
+    items = list(zip(*iterables))
+    n_items = len(items)
+    max_workers = max(1, min(8, os.cpu_count() or 1, n_items))
+    num_threads = max(1, (os.cpu_count() or 1) // max_workers)
+
+    def __call(args):
+        """
+        Calls func on one item inside a rasterio environment of the worker thread.
+
+        Args:
+            args (Tuple): positional arguments of func
+
+        Returns:
+            Any: result of func
+        """
+        with rasterio.Env(GDAL_NUM_THREADS = num_threads):
+            return func(*args, num_threads = num_threads)
+
+    pending = deque()
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers = max_workers) as pool, tqdm(total = n_items, disable = not progress) as bar:
+        while True:
+            # items are submitted as the results are consumed, so a slow consumer does not pile up results in memory
+            for args in itertools.islice(items, 2 * max_workers - len(pending)):
+                pending.append(pool.submit(__call, args))
+
+            if not pending:
+                break
+
+            result = pending.popleft().result()
+            bar.update()
+            yield result
+
+
+def _tiled_profile(profile, num_threads = 'ALL_CPUS', compress = 'deflate'):
+    """
+    This function sets a rasterio profile up to write 512x512 tiles, compressed by GDAL with num_threads. Floating point rasters use the floating point predictor.
+
+    Inputs:
+    profile: A rasterio profile, which is updated in place
+    num_threads: Number of threads GDAL uses to compress the tiles. Default is 'ALL_CPUS'.
+    compress: GDAL compression of the tiles, or None to write them uncompressed. Default is 'deflate'.
+
+    Output: The updated profile
+    """
+    profile.update(tiled = True, blockxsize = 512, blockysize = 512)
+    if compress is not None:
+        profile.update(compress = compress, num_threads = num_threads)
+        if np.dtype(profile['dtype']).kind == 'f':
+            profile['predictor'] = 3
+    return(profile)
+
+def _float32_tiled_profile(profile, num_threads = 'ALL_CPUS'):
+    """
+    This function sets a rasterio profile up to write float32 rasters as deflate compressed 512x512 tiles, like every product from Lw onwards.
+
+    Inputs:
+    profile: A rasterio profile, which is updated in place
+    num_threads: Number of threads GDAL uses to compress the tiles. Default is 'ALL_CPUS'.
+
+    Output: The updated profile
+    """
+    profile['dtype'] = 'float32'
+    return(_tiled_profile(profile, num_threads))
+
+
 ######## workflow functions ########
 
 def mobley_rho_method(sky_lt_dir, lt_dir, lw_dir, rho = 0.028): 
@@ -314,23 +398,33 @@ def mobley_rho_method(sky_lt_dir, lt_dir, lw_dir, rho = 0.028):
     lsky_median = np.median(sky_imgs,axis=(0,2,3)) # here we want the median of each band
     del sky_imgs # free up the memory
 
+    # the sky reflected radiance of each band, taken once in double precision and kept in float32 like the Lt bands
+    lsr = (rho*lsky_median.astype(np.float64)).astype(np.float32)
+
     # go through each Lt image in the dir and subtract out rho*lsky to account for sky reflection
-    for im in glob.glob(lt_dir + "/*.tif"):
-        with rasterio.open(im, 'r') as Lt_src:
+    def __compute_lw(im, num_threads):
+        """
+        Subtracts rho*Lsky from every band of an Lt image and saves the Lw image.
+
+        Args:
+            im (str): path of the Lt image
+            num_threads (int): number of GDAL threads
+        """
+        with rasterio.open(im, 'r', sharing = False) as Lt_src:
             profile = Lt_src.profile
             profile['count']=5
-            lw_all = []
-            for i in range(1,6):
-                # todo this is probably faster if we read them all and divide by the vector
-                lt = Lt_src.read(i)
-                lw = lt - (rho*lsky_median[i-1])
-                lw_all.append(lw) #append each band
-            stacked_lw = np.stack(lw_all) #stack into np.array
+            _float32_tiled_profile(profile, num_threads)
+
+            # read all five bands at once, as float32, and subtract the sky reflected radiance of each band in place
+            stacked_lw = Lt_src.read(list(range(1,6)), out_dtype = np.float32)
+            np.subtract(stacked_lw, lsr[:,None,None], out=stacked_lw)
 
             #write new stacked lw tifs
             im_name = os.path.basename(im) # we're grabbing just the .tif file name instead of the whole path
             with rasterio.open(os.path.join(lw_dir, im_name), 'w', **profile) as dst:
                 dst.write(stacked_lw)
+
+    list(_map_images(__compute_lw, glob.glob(lt_dir + "/*.tif")))
                 
     return(True)
 
@@ -349,29 +443,36 @@ def blackpixel_method(sky_lt_dir, lt_dir, lw_dir):
     """
     # grab the first ten of these images, average them, then delete this from memory
     sky_imgs, sky_img_metadata = retrieve_imgs_and_metadata(sky_lt_dir, count=10, start=0, altitude_cutoff=0, sky=True)
-    lsky_median = np.median(sky_imgs,axis=(0,2,3)) # here we want the median of each band
+    lsky_median = np.median(sky_imgs,axis=(0,2,3)).astype(np.float32) # here we want the median of each band, in float32 like the Lt bands
     del sky_imgs
 
-    for im in glob.glob(lt_dir + "/*.tif"):
-        with rasterio.open(im, 'r') as Lt_src:
+    def __compute_lw(im, num_threads):
+        """
+        Computes rho from the NIR band of an Lt image, subtracts rho*Lsky from every band and saves the Lw image.
+
+        Args:
+            im (str): path of the Lt image
+            num_threads (int): number of GDAL threads
+        """
+        with rasterio.open(im, 'r', sharing = False) as Lt_src:
             profile = Lt_src.profile
             profile['count']=5
-           
-            Lt = Lt_src.read(4)
-            rho = Lt/lsky_median[4-1]
-            lw_all = []
-            for i in range(1,6):
-                # todo this is probably faster if we read them all and divide by the vector
-                lt = Lt_src.read(i)
-                lw = lt - (rho*lsky_median[i-1]) 
-                lw_all.append(lw) #append each band
-            stacked_lw = np.stack(lw_all) #stack into np.array
+            _float32_tiled_profile(profile, num_threads)
+
+            # read all five bands at once, as float32, and broadcast rho*lsky across them
+            Lt = Lt_src.read(list(range(1,6)), out_dtype = np.float32)
+            rho = Lt[3]/lsky_median[3]
+            stacked_lw = np.empty_like(Lt)
+            np.multiply(rho, lsky_median[:5,None,None], out=stacked_lw)
+            np.subtract(Lt, stacked_lw, out=stacked_lw)
 
             #write new stacked lw tifs
             im_name = os.path.basename(im) # we're grabbing just the .tif file name instead of the whole path
             with rasterio.open(os.path.join(lw_dir, im_name), 'w', **profile) as dst:
                 dst.write(stacked_lw)
-                
+
+    list(_map_images(__compute_lw, glob.glob(lt_dir + "/*.tif")))
+
     return(True)
 
 
@@ -387,192 +488,220 @@ def hedley_method(lt_dir, lw_dir, random_n=10):
    Outputs: New Lw .tifs with units of W/sr/nm
    
    """
-    lt_all = []
-    
     rand = random.sample(glob.glob(lt_dir + "/*.tif"), random_n) #open random n files. n is selected by user in process_raw_to_rrs
-    for im in rand:
-        with rasterio.open(im, 'r') as lt_src:
-            profile = lt_src.profile
-            lt = lt_src.read()
-            lt_all.append(lt)
 
-    stacked_lt = np.stack(lt_all)
-    stacked_lt_reshape = stacked_lt.reshape(*stacked_lt.shape[:-2], -1) #flatten last two dims
+    def __min_lt_NIR(im, num_threads):
+        """
+        Computes the 0.1 percentile of the NIR band of an Lt image.
+
+        Args:
+            im (str): path of the Lt image
+            num_threads (int): number of GDAL threads
+
+        Returns:
+            float: 0.1 percentile of Lt(NIR)
+        """
+        # only the NIR band is needed, so the other bands are not read
+        with rasterio.open(im, 'r', sharing = False) as lt_src:
+            return(np.percentile(lt_src.read(5), .1))
+
+    #apply linear regression between NIR and visible bands
+    min_lt_NIR = list(_map_images(__min_lt_NIR, rand)) #calculate minimum 10% of Lt(NIR)
+    mean_min_lt_NIR = np.float32(np.mean(min_lt_NIR)) #take mean of minimum 10% of random Lt(NIR), in float32 like the Lt bands
 
-    #apply linear regression between NIR and visible bands 
-    min_lt_NIR = []
-    for i in range(len(rand)):
-        min_lt_NIR.append(np.percentile(stacked_lt_reshape[i,4,:], .1)) #calculate minimum 10% of Lt(NIR)
-    mean_min_lt_NIR = np.mean(min_lt_NIR) #take mean of minimum 10% of random Lt(NIR)
+    def __compute_lw(im, num_threads):
+        """
+        Removes the NIR-correlated glint from every band of an Lt image and saves the Lw image.
 
-    all_slopes = []
-    for i in range(len(glob.glob(lt_dir + "/*.tif"))):
-        im = glob.glob(lt_dir + "/*.tif")[i]
+        Args:
+            im (str): path of the Lt image
+            num_threads (int): number of GDAL threads
+        """
         im_name = os.path.basename(im) # we're grabbing just the .tif file name instead of the whole path
-        with rasterio.open(im, 'r') as lt_src:
+        with rasterio.open(im, 'r', sharing = False) as lt_src:
             profile = lt_src.profile
-            lt = lt_src.read()
+            lt = lt_src.read(list(range(1,6)), out_dtype = np.float32)
             lt_reshape = lt.reshape(*lt.shape[:-2], -1) #flatten last two dims
 
-        lw_all = []
-        for j in range(0,5):
-            slopes = np.polyfit(lt_reshape[4,:], lt_reshape[j,:], 1)[0] #calculate slope between NIR and all bands of random files
-            all_slopes.append(slopes)
+        #least squares slope between NIR and all bands of this image, cov(NIR,band)/var(NIR)
+        nir_centered = lt_reshape[4].astype(np.float64)
+        nir_centered -= nir_centered.mean()
+        slopes = ((lt_reshape @ nir_centered) / (nir_centered @ nir_centered)).astype(np.float32)
 
-            #calculate Lw (Lt - b(Lt(NIR)-min(Lt(NIR))))
-            lw = lt[j,:,:] - all_slopes[j]*(lt[4,:,:]-mean_min_lt_NIR)
-            lw_all.append(lw)
-
-        stacked_lw = np.stack(lw_all) #stack into np.array
+        #calculate Lw (Lt - b(Lt(NIR)-min(Lt(NIR))))
+        stacked_lw = lt - slopes[:,None,None]*(lt[4]-mean_min_lt_NIR)
         profile['count']=5
+        _float32_tiled_profile(profile, num_threads)
 
         #write new stacked Rrs tif w/ reflectance units
         with rasterio.open(os.path.join(lw_dir, im_name), 'w', **profile) as dst:
             dst.write(stacked_lw)
+
+    list(_map_images(__compute_lw, glob.glob(lt_dir + "/*.tif")))
     return(True)
 
 
+def load_captures(img_dir):
+    """
+    This function loads the captures of a directory of raw MicaSense images. Parsing the metadata of every image is slow, so the captures are cached and shared by later calls on the same directory, as long as none of its files has been added, removed or rewritten. The cached captures are only used to compute Ed, so they should not be modified. The images they decode are cleared once Ed is computed, so only their metadata stays in memory. load_captures.cache_clear() empties the cache.
+
+    Inputs:
+    img_dir: A string containing the directory filepath of the raw images
+
+    Output: A list of the Captures in the directory
+    """
+    # the name, modification time and size of every file (searched like ImageSet.from_directory) are the cache key, so images overwritten in place are reloaded too
+    files = []
+    for root, _, filenames in os.walk(img_dir):
+        for filename in filenames:
+            stat = os.stat(os.path.join(root, filename))
+            files.append((os.path.join(root, filename), stat.st_mtime_ns, stat.st_size))
+    return _load_captures(img_dir, tuple(sorted(files)))
+
+@functools.lru_cache(maxsize = 8)
+def _load_captures(img_dir, files):
+    return imageset.ImageSet.from_directory(img_dir).captures
+
+load_captures.cache_clear = _load_captures.cache_clear
+
 def panel_ed(panel_dir, lw_dir, rrs_dir, output_csv_path):
     """
-    This function calculates remote sensing reflectance (Rrs) by dividing downwelling irradiance (Ed) from the water leaving radiance (Lw) .tifs. Ed is calculated from the calibrated reflectance panel. This method does not perform well when light is variable such as partly cloudy days. It is recommended to use in the case of a clear, sunny day. 
-    
+    This function calculates remote sensing reflectance (Rrs) by dividing downwelling irradiance (Ed) from the water leaving radiance (Lw) .tifs. Ed is calculated from the calibrated reflectance panel. This method does not perform well when light is variable such as partly cloudy days. It is recommended to use in the case of a clear, sunny day.
+
     Inputs:
     panel_dir: A string containing the directory filepath of the panel image captures
     lw_dir: A string containing the directory filepath of lw images
     rrs_dir: A string containing the directory filepath of new rrs images
     output_csv_path: A string containing the filepath to save Ed measurements (mW/m2/nm) calculated from the panel
-    
+
     Outputs:
-    New Rrs .tifs with units of sr^-1 
+    New Rrs .tifs with units of sr^-1
     New .csv file with average Ed measurements (mW/m2/nm) calculated from image cpatures of the calibrated reflectance panel
-    
+
     """
-    panel_imgset = imageset.ImageSet.from_directory(panel_dir).captures
-    panels = np.array(panel_imgset)  
-    
-    ed_data = []
+    panel_imgset = load_captures(panel_dir)
+
     ed_columns = ['image', 'ed_475', 'ed_560', 'ed_668', 'ed_717', 'ed_842']
-    
-    for i in range(len(panels)):         
-        #calculate panel Ed from every panel capture
-        ed = np.array(panels[i].panel_irradiance()) # this function automatically finds the panel albedo and uses that to calcuate Ed, otherwise raises an error
-        ed[3], ed[4] = ed[4], ed[3] #flip last two bands
-        ed_row = ['capture_'+str(i+1)]+[np.mean(ed[0])]+[np.mean(ed[1])]+[np.mean(ed[2])]+[np.mean(ed[3])]+[np.mean(ed[4])]
-        ed_data.append(ed_row)
-        
-    ed_data = pd.DataFrame.from_records(ed_data, index='image', columns = ed_columns)
+
+    #calculate panel Ed from every panel capture, as one row per capture. Panel detection decodes the images, so captures are processed on a pool of threads
+    eds = np.array(list(_map_images(lambda panel_capture, num_threads: panel_capture.panel_irradiance(), panel_imgset))) # this function automatically finds the panel albedo and uses that to calcuate Ed, otherwise raises an error
+    eds = eds[:, [0, 1, 2, 4, 3]] #flip last two bands
+    ed = eds[-1]
+
+    # the captures stay cached by load_captures, so the decoded panel images are released once Ed is computed
+    for panel_capture in panel_imgset:
+        panel_capture.clear_image_data()
+
+    ed_data = pd.DataFrame(eds, index = pd.Index(['capture_'+str(i+1) for i in range(len(eds))], name = ed_columns[0]), columns = ed_columns[1:])
     ed_data.to_csv(output_csv_path+'/panel_ed.csv')
 
     # now divide the lw_imagery by Ed to get rrs
-    # go through each Lt image in the dir and divide it by the lsky
-    for im in glob.glob(lw_dir + "/*.tif"):
-        with rasterio.open(im, 'r') as Lw_src:
-            profile = Lw_src.profile
-            profile['count']=5
-            rrs_all = []
-            # could vectorize this for speed
-            for i in range(1,6):
-                lw = Lw_src.read(i)
-                
-                rrs = lw/ed[i-1]
-                rrs_all.append(rrs) #append each band
-            stacked_rrs = np.stack(rrs_all) #stack into np.array
-            
-            #write new stacked Rrs tifs w/ Rrs units
-            im_name = os.path.basename(im) # we're grabbing just the .tif file name instead of the whole path
-            with rasterio.open(os.path.join(rrs_dir, im_name), 'w', **profile) as dst:
-                dst.write(stacked_rrs)
+    # go through each Lt image in the dir and divide it by Ed, on a pool of threads since rasterio and numpy release the GIL
+    lw_paths = glob.glob(lw_dir + "/*.tif")
+    list(_map_images(lw_to_rrs, lw_paths, itertools.repeat(rrs_dir), itertools.repeat(ed)))
     return(True)
 
 
 def dls_ed(raw_water_dir, lw_dir, rrs_dir, output_csv_path, panel_dir=None, dls_corr=False):
 
     """
-    This function calculates remote sensing reflectance (Rrs) by dividing downwelling irradiance (Ed) from the water leaving radiance (Lw) .tifs. Ed is derived from the downwelling light sensor (DLS), which is collected at every image capture. This method does not perform well when light is variable such as partly cloudy days. It is recommended to use in overcast, completely cloudy conditions. A DLS correction can be optionally applied to tie together DLS and panel Ed measurements. In this case, a compensation factor derived from the calibration reflectance panel is applied to DLS Ed measurements.The defualt is False. 
-    
+    This function calculates remote sensing reflectance (Rrs) by dividing downwelling irradiance (Ed) from the water leaving radiance (Lw) .tifs. Ed is derived from the downwelling light sensor (DLS), which is collected at every image capture. This method does not perform well when light is variable such as partly cloudy days. It is recommended to use in overcast, completely cloudy conditions. A DLS correction can be optionally applied to tie together DLS and panel Ed measurements. In this case, a compensation factor derived from the calibration reflectance panel is applied to DLS Ed measurements.The defualt is False.
+
 
     Inputs:
     raw_water_dir: A string containing the directory filepath of the raw water images
     lw_dir: A string containing the directory filepath of lw images
     rrs_dir: A string containing the directory filepath of new rrs images
     output_csv_path: A string containing the filepath to save Ed measurements (mW/m2/nm) derived from the DLS
-    panel_dir: A string containing the filepath of panel images. Only need if dls_corr=True. 
-    dls_corr: Option to apply compensation factor from calibration reflectance panel to DLS Ed measurements. Default is False. 
-    
+    panel_dir: A string containing the filepath of panel images. Only need if dls_corr=True.
+    dls_corr: Option to apply compensation factor from calibration reflectance panel to DLS Ed measurements. Default is False.
+
     Outputs:
-    New Rrs .tifs with units of sr^-1 
+    New Rrs .tifs with units of sr^-1
     New .csv file with average Ed measurements (mW/m2/nm) calculated from DLS measurements
     """
-    capture_imgset = imageset.ImageSet.from_directory(raw_water_dir).captures
-    ed_data = []
+    capture_imgset = load_captures(raw_water_dir)
     ed_columns = ['image', 'ed_475', 'ed_560', 'ed_668', 'ed_717', 'ed_842']
-    
+    ed_index = pd.Index(['capture_'+str(i+1) for i in range(len(capture_imgset))], name = ed_columns[0])
+
     if not dls_corr:
-        for i,capture in enumerate(capture_imgset):
-            ed = capture.dls_irradiance()
-            ed[3], ed[4] = ed[4], ed[3] #flip last two bands (red edge and NIR)
-            ed_row = ['capture_'+str(i+1)]+[np.mean(ed[0]*1000)]+[np.mean(ed[1]*1000)]+[np.mean(ed[2]*1000)]+[np.mean(ed[3]*1000)]+[np.mean(ed[4]*1000)] #multiply by 1000 to scale to mW 
-            ed_data.append(ed_row)
+        # one row of DLS Ed per capture
+        eds = np.array([capture.dls_irradiance() for capture in capture_imgset])
+        eds = eds[:, [0, 1, 2, 4, 3]]*1000 #flip last two bands (red edge and NIR) and multiply by 1000 to scale to mW
 
-        ed_data_df = pd.DataFrame.from_records(ed_data, index='image', columns = ed_columns)
+        ed_data_df = pd.DataFrame(eds, index = ed_index, columns = ed_columns[1:])
         ed_data_df.to_csv(output_csv_path+'/dls_ed.csv')
 
     if dls_corr:
-        panel_imgset = imageset.ImageSet.from_directory(panel_dir).captures
-        panels = np.array(panel_imgset)  
-
-        panel_ed_data = []  
-        dls_ed_data = []
-        for i, capture in enumerate(panels): 
-            #calculate panel Ed from every panel capture
-            panel_ed = np.array(panels[i].panel_irradiance()) # this function automatically finds the panel albedo and uses that to calcuate Ed, otherwise raises an error
-            panel_ed[3], panel_ed[4] = panel_ed[4], panel_ed[3] #flip last two bands
-            panel_ed_row = ['capture_'+str(i+1)]+[np.mean(panel_ed[0])]+[np.mean(panel_ed[1])]+[np.mean(panel_ed[2])]+[np.mean(panel_ed[3])]+[np.mean(panel_ed[4])] #multiply by 1000 to scale to mW (but want ed to still be in W to divide by Lw which is in W)
-            panel_ed_data.append(panel_ed_row)
-
-            #calculate DLS Ed from every panel capture
-            dls_ed = capture.dls_irradiance()
-            dls_ed[3], dls_ed[4] = dls_ed[4], dls_ed[3] #flip last two bands (red edge and NIR)
-            dls_ed_row = ['capture_'+str(i+1)]+[np.mean(dls_ed[0]*1000)]+[np.mean(dls_ed[1]*1000)]+[np.mean(dls_ed[2]*1000)]+[np.mean(dls_ed[3]*1000)]+[np.mean(dls_ed[4]*1000)] #multiply by 1000 to scale to mW 
-            dls_ed_data.append(dls_ed_row)         
-
-        dls_ed_corr = np.array(panel_ed)/(np.array(dls_ed[0:5])*1000)        
+        panel_imgset = load_captures(panel_dir)
+
+        #calculate panel Ed from every panel capture. Panel detection decodes the images, so captures are processed on a pool of threads
+        panel_eds = np.array(list(_map_images(lambda panel_capture, num_threads: panel_capture.panel_irradiance(), panel_imgset))) # this function automatically finds the panel albedo and uses that to calcuate Ed, otherwise raises an error
+        panel_eds = panel_eds[:, [0, 1, 2, 4, 3]] #flip last two bands (want ed to still be in W to divide by Lw which is in W)
+
+        #calculate DLS Ed from every panel capture
+        panel_dls_eds = np.array([panel_capture.dls_irradiance() for panel_capture in panel_imgset])
+        panel_dls_eds = panel_dls_eds[:, [0, 1, 2, 4, 3]]*1000 #flip last two bands (red edge and NIR) and multiply by 1000 to scale to mW
+
+        # the captures stay cached by load_captures, so the decoded panel images are released once Ed is computed
+        for panel_capture in panel_imgset:
+            panel_capture.clear_image_data()
+
+        # the correction factor is averaged over all the panel captures
+        dls_ed_corr = panel_eds.mean(axis=0)/panel_dls_eds.mean(axis=0)
 
         # this is the DLS ed corrected by the panel correction factor
-        dls_ed_corr_data = []
-        for i,capture in enumerate(capture_imgset):
-            ed = capture.dls_irradiance()
-            ed = (ed[0:5]*dls_ed_corr)*1000
-            ed = np.append(ed, [0]) #add zero because other ed ends with a 0
-            dls_ed_corr_row = ['capture_'+str(i+1)]+[ed[0]]+[ed[1]]+[ed[2]]+[ed[3]]+[ed[4]]
-            dls_ed_corr_data.append(dls_ed_corr_row)
-
-        dls_ed_corr_data_df = pd.DataFrame.from_records(dls_ed_corr_data, index='image', columns = ed_columns)
+        eds = np.array([capture.dls_irradiance() for capture in capture_imgset])
+        eds = (eds[:, [0, 1, 2, 4, 3]]*dls_ed_corr)*1000 #flip last two bands (red edge and NIR), like the correction factor
+
+        dls_ed_corr_data_df = pd.DataFrame(eds, index = ed_index, columns = ed_columns[1:])
         dls_ed_corr_data_df.to_csv(output_csv_path+'/dls_corr_ed.csv')
 
     # now divide the lw_imagery by ed to get rrs
-    # go through each Lt image in the dir and divide it by the lsky
-    for idx, im in enumerate(glob.glob(lw_dir + "/*.tif")):
-        with rasterio.open(im, 'r') as Lw_src:
-            profile = Lw_src.profile
-            profile['count']=5
-            rrs_all = []
-            # could vectorize this for speed
-            for i in range(1,6):
-                lw = Lw_src.read(i)
-                if dls_corr:
-                    rrs = lw/dls_ed_corr_data[idx][i]
-                else:
-                    rrs = lw/ed_data[idx][i]
-                rrs_all.append(rrs) #append each band
-            stacked_rrs = np.stack(rrs_all) #stack into np.array 
-
-            #write new stacked Rrs tifs w/ Rrs units
-            im_name = os.path.basename(im) # we're grabbing just the .tif file name instead of the whole path
-            with rasterio.open(os.path.join(rrs_dir, im_name), 'w', **profile) as dst:
-                dst.write(stacked_rrs)
+    # go through each Lt image in the dir and divide it by Ed, on a pool of threads since rasterio and numpy release the GIL
+    lw_paths = glob.glob(lw_dir + "/*.tif")
+    # Lw images are named after their capture, so each one is matched to its Ed row by name and not by the (filesystem dependent) glob order
+    ed_by_name = {name+'.tif' : ed for name, ed in zip(ed_index, eds)}
+    lw_eds = [ed_by_name[os.path.basename(lw_path)] for lw_path in lw_paths]
+    list(_map_images(lw_to_rrs, lw_paths, itertools.repeat(rrs_dir), lw_eds))
     return(True)
 
+def lw_to_rrs(lw_path, rrs_dir, ed, num_threads = 'ALL_CPUS'):
+    """
+    This function calculates remote sensing reflectance (Rrs) of a single water leaving radiance (Lw) .tif by dividing each band by its downwelling irradiance (Ed). It is used by panel_ed() and dls_ed() on every Lw image.
+
+    Inputs:
+    lw_path: A string containing the filepath of the lw image
+    rrs_dir: A string containing the directory filepath of new rrs images
+    ed: A list or numpy array with the Ed of the 5 bands
+    num_threads: Number of threads GDAL uses to read and write the image. Default is 'ALL_CPUS'. Callers running several images at once split the cores among them.
+
+    Output: A string containing the filepath of the new Rrs .tif
+    """
+    # the reciprocal is taken once, in double precision, so every pixel is a multiplication
+    inv_ed = (1/np.asarray(ed[0:5], dtype=np.float64)).astype(np.float32).reshape(5, 1, 1)
+
+    im_name = os.path.basename(lw_path) # we're grabbing just the .tif file name instead of the whole path
+    rrs_path = os.path.join(rrs_dir, im_name)
+
+    # rasterio environments are per thread, so the block cache and GDAL threads are set here and not by the caller
+    with rasterio.Env(GDAL_CACHEMAX = 512, GDAL_NUM_THREADS = num_threads), rasterio.open(lw_path, 'r', sharing = False) as Lw_src:
+        profile = Lw_src.profile
+        profile['count']=5
+        _float32_tiled_profile(profile, num_threads)
+
+        # every block is read into the same buffer
+        buffer = np.empty((5, profile['blockysize'], profile['blockxsize']), dtype=np.float32)
+
+        #write new stacked Rrs tifs w/ Rrs units, block by block so only one block of the image is held in memory
+        with rasterio.open(rrs_path, 'w', **profile) as dst:
+            for _, window in dst.block_windows(1):
+                # read the 5 bands at once, as float32, and scale each one by the reciprocal of its Ed in place
+                lw = buffer[:, : window.height, : window.width]
+                Lw_src.read([1, 2, 3, 4, 5], window=window, out=lw)
+                dst.write(np.multiply(lw, inv_ed, out=lw), window=window)
+    return(rrs_path)
+
 # glint removal
 def rrs_threshold_pixel_masking(rrs_dir, masked_rrs_dir, nir_threshold = 0.01, green_threshold = 0.005):
     """
@@ -714,8 +843,10 @@ def process_raw_to_rrs(main_dir, rrs_dir_name, output_csv_path, lw_method='moble
     # this makes an assumption that there is only one panel image put in this directory
     panel_names = glob.glob(os.path.join(panel_dir, 'IMG_*.tif'))
    
-    files = os.listdir(raw_water_img_dir) # your directory path
-    print('Processing a total of ' + str(len(files)) + ' captures or ' + str(round(len(files)/5)) + ' image sets.')
+    # count the files without building a list of their names
+    with os.scandir(raw_water_img_dir) as entries: # your directory path
+        n_files = sum(1 for _ in entries)
+    print('Processing a total of ' + str(n_files) + ' captures or ' + str(round(n_files/5)) + ' image sets.')
     
     ### convert raw imagery to radiance (Lt)
     print("Converting raw images to radiance (raw -> Lt).")
@@ -809,9 +940,15 @@ def chl_hu(Rrsblue, Rrsgreen, Rrsred):
     
     ci1 = -0.4909
     ci2 = 191.6590
+    c = (560 - 475)/(668 - 475)
+
+    # CI = green - (blue + c * (red - blue)), expanded so the baseline takes fewer full size temporaries
+    CI = Rrsgreen - (1 - c) * Rrsblue
+    CI -= c * Rrsred
+    CI *= ci2
+    CI += ci1
 
-    CI = Rrsgreen - ( Rrsblue + (560 - 475)/(668 - 475) * (Rrsred - Rrsblue) )
-    ChlCI = 10**(ci1 + ci2*CI)
+    ChlCI = np.power(10, CI)
     return(ChlCI)
 
 
@@ -833,10 +970,17 @@ def chl_ocx(Rrsblue, Rrsgreen):
     a3 = 2.5635
     a4 = -0.7218
 
-    log10chl = a0 + a1 * (np.log10(Rrsblue / Rrsgreen)) \
-        + a2 * (np.log10(Rrsblue / Rrsgreen))**2 \
-            + a3 * (np.log10(Rrsblue / Rrsgreen))**3 \
-                + a4 * (np.log10(Rrsblue / Rrsgreen))**4
+    # Horner's rule, so the band ratio is computed once and no powers of it are allocated
+    ratio = np.log10(Rrsblue / Rrsgreen)
+
+    log10chl = a4 * ratio
+    log10chl += a3
+    log10chl *= ratio
+    log10chl += a2
+    log10chl *= ratio
+    log10chl += a1
+    log10chl *= ratio
+    log10chl += a0
 
     ocx = np.power(10, log10chl)
     return(ocx)
@@ -851,35 +995,26 @@ def chl_hu_ocx(Rrsblue, Rrsgreen, Rrsred):
     Output: numpy array of derived chlorophyll
     '''
 
-    thresh = [0.15, 0.20]
-    a0 = 0.1977
-    a1 = -1.8117
-    a2 = 1.9743
-    a3 = 2.5635
-    a4 = -0.7218
+    return chl_hu_ocx_blend(chl_hu(Rrsblue, Rrsgreen, Rrsred), chl_ocx(Rrsblue, Rrsgreen))
 
-    ci1 = -0.4909
-    ci2 = 191.6590
+def chl_hu_ocx_blend(ChlCI, ocx):
+    """
+    This blends the chlorophyll derived with the Hu color index (CI) algorithm (chl_hu) and the OCx algorithm (chl_ocx) into the NASA chlorophyll product. It is used by chl_hu_ocx and lets callers that already computed both products blend them without computing them again.
 
-    log10chl = a0 + a1 * (np.log10(Rrsblue / Rrsgreen)) \
-        + a2 * (np.log10(Rrsblue / Rrsgreen))**2 \
-            + a3 * (np.log10(Rrsblue / Rrsgreen))**3 \
-                + a4 * (np.log10(Rrsblue / Rrsgreen))**4
+    Inputs:
+    ChlCI: numpy array of chlorophyll derived with chl_hu
+    ocx: numpy array of chlorophyll derived with chl_ocx
 
-    ocx = np.power(10, log10chl)
+    Output: numpy array of derived chlorophyll
+    """
 
-    CI = Rrsgreen - ( Rrsblue + (560 - 475)/(668 - 475) * \
-        (Rrsred -Rrsblue) )
-        
-    ChlCI = 10** (ci1 + ci2*CI)
+    thresh = [0.15, 0.20]
 
-    if ChlCI.any() <= thresh[0]:
-        chlor_a = ChlCI
-    elif ChlCI.any() > thresh[1]:
-        chlor_a = ocx
-    else:
-        chlor_a = ocx * (ChlCI-thresh[0]) / (thresh[1]-thresh[0]) +\
-            ChlCI * (thresh[1]-ChlCI) / (thresh[1]-thresh[0])
+    # the thresholds are applied pixel by pixel, blending linearly between them
+    weight = (ChlCI - thresh[0]) / (thresh[1] - thresh[0])
+    blend = ocx * weight + ChlCI * (1 - weight)
+
+    chlor_a = np.where(ChlCI <= thresh[0], ChlCI, np.where(ChlCI > thresh[1], ocx, blend))
 
     return chlor_a
 
@@ -893,7 +1028,10 @@ def chl_gitelson(Rrsred, Rrsrededge):
     Output: numpy array of derived chlorophyll
     """
     
-    chl = 59.826 * (Rrsrededge/Rrsred) - 17.546
+    # scaled in place, so only the band ratio is allocated
+    chl = Rrsrededge/Rrsred
+    chl *= 59.826
+    chl -= 17.546
     return chl
 
 ######## TSM retrieval algs ######
@@ -911,68 +1049,136 @@ def tsm_nechad(Rrsred):
     B = 1.61
     C = 17.38
     
-    tsm = (A*Rrsred/(1-(Rrsred/C))) + B
+    # A*Rrsred/(1-(Rrsred/C)) is rewritten as A*C*Rrsred/(C-Rrsred), so a single division is needed and the rest runs in place
+    tsm = Rrsred/(C - Rrsred)
+    tsm *= A*C
+    tsm += B
     return(tsm)
 
+# names of the water quality algorithms that compute_wq_algs and save_wq_imgs accept
+WQ_ALGS = ('chl_hu', 'chl_ocx', 'chl_hu_ocx', 'chl_gitelson', 'tsm_nechad')
+
+def compute_wq_algs(rrs, wq_algs):
+    """
+    This function computes several water quality algorithms on the same Rrs bands. The products shared between algorithms (chl_hu and chl_ocx are both blended into chl_hu_ocx) are only computed once.
+
+    Inputs:
+    rrs: numpy array of Rrs with the blue, green, red, red edge and NIR bands in the first axis
+    wq_algs: list of the algorithms to compute. Options: 'chl_hu', 'chl_ocx', 'chl_hu_ocx', 'chl_gitelson', 'tsm_nechad'
+
+    Output: dictionary with the numpy array derived by each algorithm
+    """
+    unknown_algs = [wq_alg for wq_alg in wq_algs if wq_alg not in WQ_ALGS]
+    if unknown_algs:
+        raise ValueError('Unknown wq_alg {}. Options: {}'.format(unknown_algs, ', '.join(WQ_ALGS)))
+
+    Rrsblue, Rrsgreen, Rrsred, Rrsrededge = rrs[0], rrs[1], rrs[2], rrs[3]
+    wq = {}
 
-def save_wq_imgs(main_dir, rrs_img_dir, wq_dir_name, img_metadata, wq_alg="chl_gitelson", start=0, count=10000):
+    if 'chl_hu' in wq_algs or 'chl_hu_ocx' in wq_algs:
+        wq['chl_hu'] = chl_hu(Rrsblue, Rrsgreen, Rrsred)
+
+    if 'chl_ocx' in wq_algs or 'chl_hu_ocx' in wq_algs:
+        wq['chl_ocx'] = chl_ocx(Rrsblue, Rrsgreen)
+
+    if 'chl_hu_ocx' in wq_algs:
+        wq['chl_hu_ocx'] = chl_hu_ocx_blend(wq['chl_hu'], wq['chl_ocx'])
+
+    if 'chl_gitelson' in wq_algs:
+        wq['chl_gitelson'] = chl_gitelson(Rrsred, Rrsrededge)
+
+    if 'tsm_nechad' in wq_algs:
+        wq['tsm_nechad'] = tsm_nechad(Rrsred)
+
+    return {wq_alg: wq[wq_alg] for wq_alg in wq_algs}
+
+
+def save_wq_imgs(main_dir, rrs_img_dir, wq_dir_name, img_metadata=None, wq_alg="chl_gitelson", start=0, count=10000, overwrite=False):
     """
     This function saves new .tifs with units of chl (ug/L) or TSM (mg/m3).
     Inputs:
     main_dir: A string containing main directory
     rrs_img_dir: A string containing directory of Rrs images
     wq_dir_name: A string containing the directory that the wq images will be saved
-    wq_alg: what wq algorithm to apply
-    imgs: images to apply - typically from retrieve_imgs_and_metadata() function
-    img_metadata: all image metadata - typically from retrieve_imgs_and_metadata() function
-    start: The image to start loading from. Default is 0.
-    count: The amount of images to load. Default is 10000
+    wq_alg: what wq algorithm to apply. Options: 'chl_hu', 'chl_ocx', 'chl_hu_ocx', 'chl_gitelson', 'tsm_nechad' ('nechad_tsm' is accepted as an older name of 'tsm_nechad'). A list of algorithms computes all of them reading each image once, and saves each one in a folder named after the algorithm inside wq_dir_name.
+    img_metadata: Deprecated and ignored, since the wq images are named after their Rrs image. Default is None.
+    start: The image to start from, in filename order. Default is 0.
+    count: The amount of images to process from start. Default is 10000
+    overwrite: Option to overwrite wq images that have been written previously. Default is False, which only computes the wq images that are missing or older than their Rrs image.
 
     Outputs: New georeferenced .tifs with same units of images in img_dir
     """
-    # make wq_dir directory 
-    wq_dir = wq_dir_name
-    if not os.path.exists(os.path.join(main_dir, wq_dir)):
-        os.makedirs(os.path.join(main_dir, wq_dir))
-
-    for im in glob.glob(rrs_img_dir + "/*.tif")[start:count]:
-        with rasterio.open(im, 'r') as Rrs_src:
-            profile = Rrs_src.profile
-            profile['count']=5
-            Rrsblue=Rrs_src.read(1)
-            Rrsgreen=Rrs_src.read(2)
-            Rrsred=Rrs_src.read(3)
-            Rrsrededge=Rrs_src.read(4)
-            Rrsnir=Rrs_src.read(5)
+    if img_metadata is not None:
+        warnings.warn('save_wq_imgs no longer uses img_metadata, the wq images are named after their Rrs image. The argument will be removed.', DeprecationWarning, stacklevel = 2)
 
-        if wq_alg == 'chl_hu':
-            wq = chl_hu(Rrsblue, Rrsgreen, Rrsred)
+    # check the algorithms before any folder or image is created, so a wrong name does not leave empty wq images behind
+    wq_algs = [wq_alg] if isinstance(wq_alg, str) else list(wq_alg)
+    wq_algs = ['tsm_nechad' if alg == 'nechad_tsm' else alg for alg in wq_algs]
+    unknown_algs = [alg for alg in wq_algs if alg not in WQ_ALGS]
+    if unknown_algs:
+        raise ValueError('Unknown wq_alg {}. Options: {}'.format(unknown_algs, ', '.join(WQ_ALGS)))
 
-        elif wq_alg == 'chl_ocx':
-            wq = chl_ocx(Rrsblue, Rrsgreen)
+    # make wq_dir directory, with one folder per algorithm if several are computed
+    wq_dirs = {alg : os.path.join(main_dir, wq_dir_name) if isinstance(wq_alg, str) else os.path.join(main_dir, wq_dir_name, alg) for alg in wq_algs}
+    for wq_dir in wq_dirs.values():
+        os.makedirs(wq_dir, exist_ok = True)
 
-        elif wq_alg == 'chl_hu_ocx':
-            wq = chl_hu_ocx(Rrsblue, Rrsgreen, Rrsred)
+    with os.scandir(rrs_img_dir) as entries:
+        rrs_imgs = sorted(entry.path for entry in entries if entry.name.endswith('.tif'))
 
-        elif wq_alg == 'chl_gitelson':
-            wq = chl_gitelson(Rrsred, Rrsrededge)
-
-        elif wq_alg == 'nechad_tsm':
-            wq = nechad_tsm(Rrsred)
+    def __save_wq_img(im, num_threads):
+        """
+        Computes the water quality algorithms of an Rrs image and saves one raster per algorithm.
 
-    for i in range(len(rrs_img_dir)):
-        with rasterio.open(os.path.join(rrs_img_dir, img_metadata.index[i]), 'r') as src:
-            src_crs = "EPSG:4326" 
-            dst_crs = "EPSG:4326"
-            profile.update(dtype=rasterio.float32,crs=dst_crs,count=1)
+        Args:
+            im (str): path of the Rrs image
+            num_threads (int): number of GDAL threads
+        """
 
-            #write new tifs 
-            with rasterio.open(os.path.join(main_dir, wq_dir, img_metadata.index[i]), 'w', **profile) as dst:
-                dst.write(wq, 1)
+        # skip the products already saved after the image was written, unless overwriting
+        out_paths = {alg : os.path.join(wq_dirs[alg], os.path.basename(im)) for alg in wq_algs}
+        algs = [alg for alg in wq_algs if overwrite or not os.path.exists(out_paths[alg]) or os.path.getmtime(out_paths[alg]) < os.path.getmtime(im)]
+        if not algs:
+            return
+
+        # the wq images only take their final name once every block is written, so a run that fails partway never leaves an image that looks up to date
+        tmp_paths = {alg : out_paths[alg] + '.part' for alg in algs}
+        try:
+            with rasterio.open(im, 'r', sharing = False) as Rrs_src, ExitStack() as stack:
+                profile = Rrs_src.profile
+                dst_crs = "EPSG:4326"
+                profile.update(crs=dst_crs,count=1)
+                _float32_tiled_profile(profile, num_threads)
+
+                #write new tifs under a temporary name
+                dsts = {alg : stack.enter_context(rasterio.open(tmp_paths[alg], 'w', **profile)) for alg in algs}
+
+                # the algorithms keep the dtype of the bands, so reading float32 keeps the whole computation in float32.
+                # Every block is read into the same buffer
+                buffer = np.empty((Rrs_src.count, profile['blockysize'], profile['blockxsize']), dtype = np.float32)
+
+                # compute block by block, so the bands and the intermediates of the algorithms stay small
+                for _, window in dsts[algs[0]].block_windows(1):
+                    rrs = buffer[:, : window.height, : window.width]
+                    Rrs_src.read(window = window, out = rrs)
+                    wq = compute_wq_algs(rrs, algs)
+
+                    for alg in algs:
+                        dsts[alg].write(wq[alg], 1, window = window)
+        except BaseException:
+            for tmp_path in tmp_paths.values():
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            raise
+
+        for alg in algs:
+            os.replace(tmp_paths[alg], out_paths[alg])
+
+    list(_map_images(__save_wq_img, rrs_imgs[start:start+count]))
     
 ###### Georeferencing #######
 
-def georeference(metadata, input_dir, output_dir, lines = None, altitude = None, yaw = None, pitch = 0, roll = 0, axis_to_flip = None):
+def georeference(metadata, input_dir, output_dir, lines = None, altitude = None, yaw = None, pitch = 0, roll = 0, axis_to_flip = None, compress = None, overviews = False):
     """
     This function georeferences all the captures indicated in the line parameter following the specification of the other parameters such as altitude, yaw, pitch, roll, axis_to_flip
 
@@ -985,39 +1191,78 @@ def georeference(metadata, input_dir, output_dir, lines = None, altitude = None,
     yaw: sets the sensor's direction angle during all captures. Defaults to None which uses the yaw angle saved in the metadata for each respective capture.
     pitch: sets the sensor's pitch angle during all captures. Defaults to 0 which means the sensor was horizontal to the ground.
     roll: sets the sensor's roll angle during all captures. Defaults to 0 which means the sensor was horizontal to the ground.
-    axis_to_flip: The axis to apply a flip. Defaults to None.
+    axis_to_flip: The axis (or list of axes) to apply a flip, in (band, row, col) order. Defaults to None.
+    compress: GDAL compression of the georeferenced .tifs, for example 'deflate'. Defaults to None (uncompressed), which is much faster to write. DEFLATE is written at its fastest level.
+    overviews: Whether to build internal overviews in each georeferenced .tif, which speeds up viewing single captures in GIS software. mosaic() reads the captures at full resolution and does not use them. Defaults to False.
     
     Output: Georeferenced .tifs in output_dir 
 """
 
-    def __get_transform(f, sensor_size, image_size, lat, lon, alt, yaw, pitch, roll):
+    @functools.lru_cache(maxsize = 8)
+    def __get_projection(f, sensor_size, image_size):
         """
-        Calculates a transformation matrix for a given capture in order to get every lat, lon for each pixel in the image.
+        Builds the intrinsic part of the camera. It only depends on the lens and sensor, so it is shared by every capture of the same camera.
+
+        Args:
+            f (float): focal_length
+            sensor_size (Tuple[float, float]): correspondence pixel -> milimeter
+            image_size (Tuple[int, int]): number of pixels for width and height
+
+        Returns:
+            RectilinearProjection: camera projection
+        """
+
+        return ct.RectilinearProjection(focallength_mm = f, sensor = sensor_size, image = image_size)
+
+    @functools.lru_cache(maxsize = None)
+    def __get_corners(f, sensor_size, image_size, alt, yaw, pitch, roll):
+        """
+        Projects the four corners of a capture onto the ground. Only the camera geometry is needed here, the lat, lon of the camera is applied afterwards for all captures at once.
+        Cached, so when altitude, yaw, pitch and roll are fixed by the caller the projection is computed only once for the whole flight.
 
         Args:
             f (float): focal_length
             sensor_size (Tuple[float, float]): correspondence pixel -> milimeter
             image_size (Tuple[int, int]): number of pixels for width and height
-            lat (float): latitude of camera
-            lon (float): longitude of camera
             alt (float): altitude of camera
             yaw (float): yaw of camera
             pitch (float): tilt of camera
             roll (float): roll of camera
 
         Returns:
-            Affine: transformation matrix
+            ndarray: (4, 3) corners in meters relative to the camera position
         """
 
-        cam = ct.Camera(ct.RectilinearProjection(focallength_mm = f, sensor = sensor_size, image = image_size),
+        cam = ct.Camera(__get_projection(f, tuple(sensor_size), tuple(image_size)),
                         ct.SpatialOrientation(elevation_m = alt, tilt_deg = pitch, roll_deg = roll, heading_deg = yaw, 
                                             pos_x_m = 0, pos_y_m = 0))
 
-        cam.setGPSpos(lat, lon, alt)
+        corners = np.array([[0, 0], [image_size[0] - 1, 0], [image_size[0] - 1, image_size[1] - 1], [0, image_size[1] - 1]], dtype = np.float64)
+
+        return cam.spaceFromImage(corners, Z = 0)
+
+    def __get_transform(coords, image_size):
+        """
+        Calculates a transformation matrix for a given capture in order to get every lat, lon for each pixel in the image.
+
+        Args:
+            coords (ndarray): (4, 3) lat, lon, alt of the capture corners
+            image_size (Tuple[int, int]): number of pixels for width and height
+
+        Returns:
+            Affine: transformation matrix
+        """
+
+        # with no pitch/roll the footprint is a parallelogram and three corners define the affine exactly, no least squares needed
+        if np.allclose(coords[0, :2] + coords[2, :2], coords[1, :2] + coords[3, :2], rtol = 0, atol = 1e-9):
+            rows, cols = image_size[0] - 1, image_size[1] - 1
+            return Affine(a = (coords[3, 1] - coords[0, 1]) / cols,
+                          b = (coords[1, 1] - coords[0, 1]) / rows,
+                          c = coords[0, 1],
+                          d = (coords[3, 0] - coords[0, 0]) / cols,
+                          e = (coords[1, 0] - coords[0, 0]) / rows,
+                          f = coords[0, 0])
 
-        coords : np.absndarray = np.array([cam.gpsFromImage([0, 0]), cam.gpsFromImage([image_size[0] - 1, 0]), 
-                                        cam.gpsFromImage([image_size[0] - 1, image_size[1] - 1]), cam.gpsFromImage([0, image_size[1] - 1])])
-                
         gcp1 = rasterio.control.GroundControlPoint(row = 0, col = 0, x = coords[0, 1], y = coords[0, 0], z = coords[0, 2])
         gcp2 = rasterio.control.GroundControlPoint(row = image_size[0] - 1, col = 0, x = coords[1, 1], y = coords[1, 0], z = coords[1, 2])
         gcp3 = rasterio.control.GroundControlPoint(row = image_size[0] - 1, col = image_size[1] - 1, x = coords[2, 1], y = coords[2, 0], z = coords[2, 2])
@@ -1043,47 +1288,143 @@ def georeference(metadata, input_dir, output_dir, lines = None, altitude = None,
 
         lines = lines if lines is not None else [ slice(0, None) ]
 
-        georeference_by_uuid = {}
+        uuids, image_sizes, corners, positions = [], [], [], []
 
         for line in lines:
             captures = metadata.iloc[line]
-            
-            for _, capture in captures.iterrows():
-                focal = capture['FocalLength']
-                image_size = (capture['ImageWidth'], capture['ImageHeight'])[::-1]
-                sensor_size = (capture['SensorX'], capture['SensorY'])[::-1]
+
+            # pull every column once instead of building a Series per capture
+            filenames = captures['filename'].map(os.path.basename).to_numpy()
+            focals = captures['FocalLength'].to_numpy()
+            widths, heights = captures['ImageWidth'].to_numpy(), captures['ImageHeight'].to_numpy()
+            sensors_x, sensors_y = captures['SensorX'].to_numpy(), captures['SensorY'].to_numpy()
+            lons = captures['Longitude'].to_numpy(dtype = np.float64)
+            lats = captures['Latitude'].to_numpy(dtype = np.float64)
+            alts = captures['Altitude'].to_numpy(dtype = np.float64)
+            pitches = captures['Pitch'].to_numpy(dtype = np.float64)
+            rolls = captures['Roll'].to_numpy(dtype = np.float64)
+            yaws = captures['Yaw'].to_numpy(dtype = np.float64)
+
+            for i in range(len(captures)):
+                focal = focals[i]
+                image_size = (widths[i], heights[i])[::-1]
+                sensor_size = (sensors_x[i], sensors_y[i])[::-1]
                 
-                lon = float(capture['Longitude'])
-                lat = float(capture['Latitude'])
-                alt = float(capture['Altitude']) if altitude is None else altitude
-                capture_pitch = float(capture['Pitch']) if pitch is None else pitch
-                capture_roll = float(capture['Roll']) if roll is None else roll
-                capture_yaw = float(capture['Yaw']) if yaw is None else yaw
+                lon = float(lons[i])
+                lat = float(lats[i])
+                alt = float(alts[i]) if altitude is None else altitude
+                capture_pitch = float(pitches[i]) if pitch is None else pitch
+                capture_roll = float(rolls[i]) if roll is None else roll
+                capture_yaw = float(yaws[i]) if yaw is None else yaw
+
+                uuids.append(filenames[i])
+                image_sizes.append(image_size)
+                corners.append(__get_corners(focal, tuple(sensor_size), tuple(image_size), alt, capture_yaw, capture_pitch, capture_roll))
+                positions.append((lat, lon, alt))
+
+        if not uuids:
+            return {}
+
+        # move every corner from the camera position to lat, lon in a single vectorized call
+        corners = np.array(corners).reshape(-1, 3)
+        positions = np.repeat(np.array(positions), 4, axis = 0)
+        coords = np.asarray(ct.gpsFromSpace(corners, positions)).reshape(-1, 4, 3)
+
+        return { uuid : __get_transform(coords[i], image_sizes[i]) for i, uuid in enumerate(uuids) }
+
+    def __open_source(input_path):
+        """
+        Opens a source capture on the reader thread, which owns the dataset from then on. GDAL datasets must not be shared between threads, so every read and the close are run on the reader thread too.
+
+        Args:
+            input_path (str): path of the source capture
+
+        Returns:
+            Tuple[DatasetReader, dict]: source dataset and its profile
+        """
+
+        with rasterio.Env(GDAL_CACHEMAX = 512, GDAL_NUM_THREADS = 'ALL_CPUS'):
+            src = rasterio.open(input_path, 'r', sharing = False)
+
+        return src, src.profile
+
+    def __read_block(src, window, axes):
+        """
+        Reads the source pixels that land on a destination block once the flip is applied. It runs on the reader thread that opened src.
+
+        Args:
+            src (DatasetReader): source dataset
+            window (Window): destination block
+            axes (Tuple[int]): axes to flip, in (band, row, col) order
+
+        Returns:
+            ndarray: data of the block
+        """
+
+        col_off, row_off = window.col_off, window.row_off
+        # a flipped block comes from the mirrored position in the source
+        if 1 in axes:
+            row_off = src.height - row_off - window.height
+        if 2 in axes:
+            col_off = src.width - col_off - window.width
 
-                georeference_by_uuid[os.path.basename(capture['filename'])] = __get_transform(focal, sensor_size, image_size, lat, 
-                                                                                            lon, alt, capture_yaw, capture_pitch, 
-                                                                                            capture_roll)
+        with rasterio.Env(GDAL_CACHEMAX = 512, GDAL_NUM_THREADS = 'ALL_CPUS'):
+            data = src.read(window = Window(col_off, row_off, window.width, window.height))
 
-        return georeference_by_uuid
+        if axes:
+            # negative-stride view, no copy of the bands
+            flip = [slice(None)] * data.ndim
+            for axis in axes:
+                flip[axis] = slice(None, None, -1)
+            data = data[tuple(flip)]
+
+        return data
     
 
     out_folder_path = output_dir
     os.makedirs(out_folder_path, exist_ok = True)
 
-    metadata = metadata.set_index(metadata['filename'])
     georefence_by_uuid = __get_georefence_by_uuid(metadata, lines, altitude, yaw, pitch, roll)
-
-    for uuid, transform in tqdm(georefence_by_uuid.items(), total = len(georefence_by_uuid.items())):
-
-        with rasterio.open(os.path.join(input_dir, uuid), 'r') as src:
-            profile = src.profile
-            profile['transform'] = transform
-            profile['count'] = src.profile['count']
-            profile['crs'] = CRS.from_user_input(4326) # Latitude, longitude]
-
-            with rasterio.open(os.path.join(output_dir, uuid), 'w', **profile) as dst:
-                data = src.read().astype(profile['dtype'])
-                dst.write( data if axis_to_flip is None else np.flip(data, axis = axis_to_flip) )
+    input_paths = [os.path.join(input_dir, uuid) for uuid in georefence_by_uuid]
+    output_paths = [os.path.join(output_dir, uuid) for uuid in georefence_by_uuid]
+    transforms = list(georefence_by_uuid.values())
+    crs = CRS.from_user_input(4326) # Latitude, longitude
+    axes = () if axis_to_flip is None else tuple(int(axis) % 3 for axis in np.atleast_1d(axis_to_flip))
+
+    with rasterio.Env(GDAL_CACHEMAX = 512, GDAL_NUM_THREADS = 'ALL_CPUS'), ThreadPoolExecutor(max_workers = 1) as reader:
+        for input_path, output_path, transform in tqdm(zip(input_paths, output_paths, transforms), total = len(transforms)):
+
+            src, profile = reader.submit(__open_source, input_path).result()
+            try:
+                profile['transform'] = transform
+                profile['crs'] = crs
+                # compression is opt-in, since it costs far more time than it saves on writing. When asked for, GDAL compresses the blocks with all cores
+                _tiled_profile(profile, compress = compress)
+                if compress is not None and compress.lower() == 'deflate':
+                    profile['zlevel'] = 1
+
+                with rasterio.open(output_path, 'w', **profile) as dst:
+                    # stream the capture block by block, reading the next block while the current one is written
+                    windows = [window for _, window in dst.block_windows(1)]
+                    next_block = reader.submit(__read_block, src, windows[0], axes)
+
+                    for i, window in enumerate(windows):
+                        data = next_block.result()
+                        if i + 1 < len(windows):
+                            next_block = reader.submit(__read_block, src, windows[i + 1], axes)
+
+                        dst.write(data, window = window)
+
+                    # optional internal overviews down to a single block, written while the capture is still in the GDAL cache
+                    if overviews:
+                        factors = []
+                        while max(dst.width, dst.height) / 2 ** len(factors) > 512:
+                            factors.append(2 ** (len(factors) + 1))
+                        if factors:
+                            dst.build_overviews(factors, Resampling.average)
+                            dst.update_tags(ns = 'rio_overview', resampling = 'average')
+            finally:
+                reader.submit(src.close).result()
 
                 
 ##### Mosaicking #####
@@ -1254,7 +1595,7 @@ class Paralelogram2D:
 ### END Geometry functions ###
 
 
-def mosaic(input_dir, output_dir, output_name, method = 'mean', dtype = np.float32, band_names = None):
+def mosaic(input_dir, output_dir, output_name, method = 'mean', dtype = np.float32, band_names = None, scratch_dir = None):
     """This function moasics all the given rasters into a single raster file 
 
         Inputs:
@@ -1264,6 +1605,7 @@ def mosaic(input_dir, output_dir, output_name, method = 'mean', dtype = np.float
         method: Method to be used when multiple captures coincide at same location. Options: 'mean', 'first', 'min', 'max'. Defaults to 'mean'.
         dtype: dtype of the mosaicked raster. Defaults to np.float32.
         band_names: List of band names. If it is not None, it writes one file for each band instead of one file with all the bands. Defaults to None.
+        scratch_dir: a string containing the directory filepath where the temporary merge arrays are kept while the mosaic is built. They are as large as the uncompressed mosaic. Defaults to None, which uses the system temporary directory.
 
         Returns:
         Mosaicked .tif file
@@ -1279,44 +1621,33 @@ def mosaic(input_dir, output_dir, output_name, method = 'mean', dtype = np.float
     
     output_name = os.path.join(out_folder_path, f'{output_name}.tif')     
     
-    def __latlon_to_index(dst , src):
+    def __latlon_to_index(dst_transform, src):
         """
-        Given a source dataset and a destination dataset. Get the latitudes and longitudes that correspond to move the source data to the destination data.
+        Given a source dataset and a destination transform. Get the latitudes and longitudes that correspond to move the source data to the destination data.
 
         Args:
-            dst (_type_): Destination dataset
+            dst_transform (Affine): Destination transformation matrix
             src (DatasetReader): Source dataset
 
         Returns:
             ndarray: List of latitudes and longitudes
         """
 
-        cols, rows = np.meshgrid(np.arange(src.width), np.arange(src.height))
-        
-        xs, ys = rasterio.transform.xy(src.transform, rows, cols)
-        lons, lats = np.array(xs), np.array(ys)
-
-        coords_to_index = np.array([ dst.index(lons[i], lats[i]) for i in np.arange(src.height)])
-        lons, lats = coords_to_index[:, 0, :], coords_to_index[:, 1, :]
-        
-        return lons, lats
+        # pixel centers of src -> pixel of dst, composed into a single affine
+        a, b, c, d, e, f = ((~dst_transform) * src.transform * Affine.translation(0.5, 0.5))[:6]
 
-    def __get_raster_corners(raster_path):
-        """
-        Given a raster path, return a list of its corners based on its transformation matrix.
-
-        Args:
-            raster_path (str): path of the raster to be processed
+        cols = np.arange(src.width, dtype = np.float64)
+        rows = np.arange(src.height, dtype = np.float64)
 
-        Returns:
-            List[Tuple[float, float]]: List with the 4 corners of the raster
-        """
+        # the offsets are folded into the 1-D terms, so each grid takes a single full size add
+        lons = np.add.outer(e * rows + f, d * cols)
+        lats = np.add.outer(b * rows + c, a * cols)
 
-        raster = rasterio.open(raster_path)
-        w, h = raster.width, raster.height
+        lons = np.floor(lons, out = lons).astype(np.intp)
+        lats = np.floor(lats, out = lats).astype(np.intp)
+        
+        return lons, lats
 
-        return [raster.transform * p for p in [(0, 0), (0, h - 1), (w - 1, h - 1), (w - 1, 0)]]
-    
     def __get_raster_corners_by_params(transform, width, height):
         """
         Given a transformation matrix, a width and a height, return a list of corners based on the given transformation matrix.
@@ -1330,70 +1661,189 @@ def mosaic(input_dir, output_dir, output_name, method = 'mean', dtype = np.float
             List[Tuple[float, float]]: List with the 4 corners of the raster
         """
 
-        return [transform * p for p in [(0, 0), (0, height - 1), (width - 1, height - 1), (width - 1, 0)]]
+        return [transform * p for p in [(0, 0), (0, height), (width, height), (width, 0)]]
 
-    def __get_merge_transform(raster_paths, max_iterations = 10000):
+    def __get_merge_transform(raster_paths):
         """This function returns a transform matrix that contains of the specified rasters
 
         Args:
             raster_paths (set): raster paths to merge
-            max_iterations (int, optional): additional merge parameters. Default is 2000
 
         Returns:
             Tuple[int, int, Affine]: width, height and transformation matrix of the merge
         """
 
-        with rasterio.open(raster_paths[0]) as src:
-            original_transform  = src.transform
-            transform  = src.transform
-            width = src.width
-            height = src.height
-            res = src.res
-        
+        # open every raster once and keep what is needed from it
+        transforms, resolutions, raster_corners = [], [], []
         for raster_path in raster_paths:
             with rasterio.open(raster_path) as src:
-                if res[0] < src.res[0]:
-                    original_transform = src.transform
-                    transform = src.transform
-                    res = src.res
+                transforms.append(src.transform)
+                resolutions.append(src.res)
+                raster_corners.append(__get_raster_corners_by_params(src.transform, src.width, src.height))
 
-        
-        raster_corners = np.array([__get_raster_corners(raster_path = raster_path) for raster_path in raster_paths]).reshape(-1, 2)
-
-        mid_point = get_center(raster_corners)
-        mid_point_first_capture = get_center(raster_corners[0 : 4])
-        c, f = mid_point[0] + (raster_corners[0][0] - mid_point_first_capture[0]), mid_point[1] + (raster_corners[0][1] - mid_point_first_capture[1])
-
-        transform = Affine(a = original_transform.a,
-                        b = original_transform.b,
-                        c = c,
-                        d = original_transform.d,
-                        e = original_transform.e,
-                        f = f,
-                        )
-        
-        paralelo = Paralelogram2D( np.array( __get_raster_corners_by_params(transform, width, height) ))
-    
-        for line_index in range(len(paralelo.lines)):
-            offset = paralelo.get_offset_to_lines(line_index, paralelo.get_center())
+        original_transform, res = transforms[0], resolutions[0]
+        for raster_transform, raster_res in zip(transforms, resolutions):
+            if res[0] < raster_res[0]:
+                original_transform = raster_transform
+                res = raster_res
 
-            iteration = 0
-            while not paralelo.are_on_right_side_of_line(line_index, raster_corners) and iteration < max_iterations:
-                paralelo.move_line_from_offset(line_index, offset)
-                iteration += 1
+        raster_corners = np.array(raster_corners).reshape(-1, 2)
 
-        width = int(round(euclidean_distance(paralelo.points[0], paralelo.points[-1]) / res[0]))
-        height = int(round(euclidean_distance(paralelo.points[0], paralelo.points[1]) / res[1]))
-        
-        transform = Affine(a = original_transform.a,
-                        b = original_transform.b,
-                        c = paralelo.points[0][0],
-                        d = original_transform.d,
-                        e = original_transform.e,
-                        f = paralelo.points[0][1])
+        # express every corner in the pixel axes of the merge, the bounding paralelogram is then just their min and max
+        basis = Affine(a = original_transform.a,
+                       b = original_transform.b,
+                       c = 0,
+                       d = original_transform.d,
+                       e = original_transform.e,
+                       f = 0)
+
+        cols, rows = ~basis * (raster_corners[:, 0], raster_corners[:, 1])
+
+        width = int(np.ceil(cols.max() - cols.min()))
+        height = int(np.ceil(rows.max() - rows.min()))
+
+        transform = basis * Affine.translation(cols.min(), rows.min())
         
         return width, height, transform
 
+    def __read_raster(raster_path, dst_transform, dst_shape, band_index = None, buffer = None):
+        """
+        Reads the part of a raster that falls inside the destination raster and locates its pixels there. It runs on a reader thread, so it opens its own dataset.
+
+        Args:
+            raster_path (str): path of the raster to read
+            dst_transform (Affine): transformation matrix of the destination raster
+            dst_shape (Tuple[int, int]): height and width of the destination raster
+            band_index (int | None, optional): if not None we only read the specified band. Defaults to None.
+            buffer (ndarray | None, optional): scratch buffer to read into. A larger one is allocated if it is missing or too small. Defaults to None.
+
+        Returns:
+            Tuple[ndarray, ndarray | slice, ndarray | slice, ndarray] | None: data, latitudes and longitudes of the raster in the destination raster and the buffer holding the data. Latitudes and longitudes are slices when the raster lands on a contiguous block. None if it does not overlap the destination raster.
+        """
+
+        with rasterio.open(raster_path, 'r', sharing = False) as src:
+            # locate the pixels first, so only the overlapping window is decoded
+            lons, lats = __latlon_to_index(dst_transform, src)
+            inside = (lons >= 0) & (lons < dst_shape[0]) & (lats >= 0) & (lats < dst_shape[1])
+
+            inside_rows, inside_cols = np.flatnonzero(inside.any(axis = 1)), np.flatnonzero(inside.any(axis = 0))
+            if inside_rows.size == 0:
+                return None
+
+            row_start, row_stop = inside_rows[0], inside_rows[-1] + 1
+            col_start, col_stop = inside_cols[0], inside_cols[-1] + 1
+            window = Window.from_slices((row_start, row_stop), (col_start, col_stop))
+
+            # read straight into the scratch buffer instead of allocating an array per raster
+            shape = (src.count if band_index is None else 1, row_stop - row_start, col_stop - col_start)
+            dtype = np.dtype(src.dtypes[0])
+            if buffer is None or buffer.dtype != dtype:
+                buffer = np.empty(shape, dtype = dtype)
+            elif np.any(np.less(buffer.shape, shape)):
+                buffer = np.empty(np.maximum(buffer.shape, shape), dtype = dtype)
+
+            data = buffer[:shape[0], :shape[1], :shape[2]]
+            src.read(None if band_index is None else [band_index], window = window, out = data)
+
+        lons, lats = lons[row_start : row_stop, col_start : col_stop], lats[row_start : row_stop, col_start : col_stop]
+        inside = inside[row_start : row_stop, col_start : col_stop]
+
+        if not inside.all():
+            data, lons, lats = data[:, inside], lons[inside], lats[inside]
+        else:
+            # an axis aligned raster at the mosaic resolution lands on a contiguous block, which is sliced instead of gathered
+            rows = lons[0, 0] + np.arange(lons.shape[0])
+            cols = lats[0, 0] + np.arange(lats.shape[1])
+            if np.array_equal(lons[:, 0], rows) and np.array_equal(lats[0], cols) and (lons == rows[:, None]).all() and (lats == cols[None, :]).all():
+                lons, lats = slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1)
+
+        return data, lons, lats, buffer
+
+    def __read_rasters(dst, raster_paths, band_index = None):
+        """
+        Reads the rasters to merge on a pool of threads and yields them in the given order, skipping those outside the destination raster. At most two rasters per thread are held in memory, and their buffers are reused once the yielded data has been merged. The progress bar only counts the rasters that are merged.
+
+        Args:
+            dst (_type_): destination raster
+            raster_paths (List[str]): raster paths to merge
+            band_index (int | None, optional): if not None we only read the specified band. Defaults to None.
+
+        Yields:
+            Tuple[ndarray, ndarray, ndarray]: data, latitudes and longitudes of each raster in the destination raster
+        """
+
+        buffers = deque()
+
+        def __read(raster_path, num_threads):
+            """
+            Reads a raster on a reader thread, into a buffer already merged by the caller if there is one.
+
+            Args:
+                raster_path (str): path of the raster to read
+                num_threads (int): number of GDAL threads
+
+            Returns:
+                Tuple[Tuple | None, ndarray | None]: raster read by __read_raster and the buffer to reuse once it is merged
+            """
+
+            try:
+                buffer = buffers.pop()
+            except IndexError:
+                buffer = None
+
+            raster = __read_raster(raster_path, dst.transform, (dst.height, dst.width), band_index, buffer)
+            return raster, buffer if raster is None else raster[3]
+
+        with tqdm(total = len(raster_paths)) as progress:
+            for raster, buffer in _map_images(__read, raster_paths, progress = False):
+                if raster is not None:
+                    data, lons, lats, _ = raster
+                    yield data, lons, lats
+                    progress.update()
+                else:
+                    # a raster outside the destination raster is not merged, so it is taken out of the total
+                    progress.total -= 1
+                    progress.refresh()
+
+                # the caller is done with the data once it asks for the next raster
+                if buffer is not None:
+                    buffers.append(buffer)
+
+    def __write(dst, data):
+        """
+        Writes the merge to the destination raster block by block, so the disk backed merge array is streamed instead of loaded into memory at once.
+
+        Args:
+            dst (_type_): destination raster
+            data (ndarray): merge to write, with one band per band of the destination raster
+        """
+
+        for _, window in dst.block_windows(1):
+            (row_start, row_stop), (col_start, col_stop) = window.toranges()
+            dst.write(data[:, row_start : row_stop, col_start : col_stop], window = window)
+
+    def __allocate(shape, dtype, fill_value = None):
+        """
+        Allocates a merge array backed by a temporary file in the scratch folder, so mosaics larger than RAM can be built.
+
+        Args:
+            shape (Tuple[int, int, int]): shape of the array
+            dtype (dtype): dtype of the array
+            fill_value (float | None, optional): initial value. Defaults to None which means zeros.
+
+        Returns:
+            memmap: the allocated array
+        """
+
+        fd, path = tempfile.mkstemp(suffix = '.dat', dir = scratch_path)
+        os.close(fd)
+
+        array = np.memmap(path, dtype = dtype, mode = 'w+', shape = shape)
+        if fill_value is not None:
+            array[:] = fill_value
+
+        return array
+
     def __mean(dst, raster_paths, n_bands, width, height, dtype = np.float32, band_index = None):
         """
         Merge method that calculates the mean value in those positions where more than one raster write its values.
@@ -1411,20 +1861,31 @@ def mosaic(input_dir, output_dir, output_name, method = 'mean', dtype = np.float
             ndarray: resulting merge
         """
 
-        final_data = np.zeros(shape = (n_bands, height, width), dtype = dtype)
-        count = np.zeros(shape = (n_bands, height, width), dtype = np.uint8)
+        final_data = __allocate(shape = (n_bands, height, width), dtype = dtype)
+        # uint8 would silently wrap around where more than 255 captures overlap
+        count = __allocate(shape = (n_bands, height, width), dtype = np.uint16)
 
-        for raster_path in tqdm(raster_paths):
-            with rasterio.open(raster_path, 'r') as src:
-                data = src.read() if band_index is None else np.array([src.read(band_index)])
-                
-                lons, lats = __latlon_to_index(dst, src)
+        for data, lons, lats in __read_rasters(dst, raster_paths, band_index):
+
+            # accumulate in place on the pixels covered by this raster, without stacking temporaries
+            valid = ~np.isnan(data)
+
+            dst_data = final_data[:, lons, lats]
+            np.add(dst_data, data, out = dst_data, where = valid)
+            final_data[:, lons, lats] = dst_data
+
+            dst_count = count[:, lons, lats]
+            np.add(dst_count, valid, out = dst_count, casting = 'unsafe')
+            count[:, lons, lats] = dst_count
+
+        # divide in place band by band, so no full size result is allocated in memory
+        for band in range(n_bands):
+            covered = count[band] > 0
+            np.divide(final_data[band], count[band], out = final_data[band], where = covered)
+            final_data[band][~covered] = np.nan
+
+        return final_data
 
-                final_data[:, lons, lats] = np.nansum([data, final_data[:, lons, lats]], axis = 0)
-                count[:, lons, lats] = np.nansum([~np.isnan(data), count[:, lons, lats]], axis = 0)
-                
-        return np.divide(final_data, count)
-    
     def __first(dst, raster_paths, n_bands, width, height, dtype = np.float32, band_index = None):
         """
         Merge method that keeps the first value in write those positions where more than one raster write its values.
@@ -1442,19 +1903,14 @@ def mosaic(input_dir, output_dir, output_name, method = 'mean', dtype = np.float
             ndarray: resulting merge
         """
 
-        final_data = np.empty(shape = (n_bands, height, width), dtype = dtype)
-        final_data[:] = np.NaN
+        final_data = __allocate(shape = (n_bands, height, width), dtype = dtype, fill_value = np.nan)
 
-        for raster_path in tqdm(raster_paths):
-            with rasterio.open(raster_path, 'r') as src:
-                data = src.read() if band_index is None else np.array([src.read(band_index)])
+        for data, lons, lats in __read_rasters(dst, raster_paths, band_index):
+
+            dst_arr = final_data[:, lons, lats]
+            np.copyto(dst_arr, data, where = np.isnan(dst_arr) * ~np.isnan(data))
+            final_data[:, lons, lats] = dst_arr
 
-                lons, lats = __latlon_to_index(dst, src)
-                
-                dst_arr = final_data[:, lons, lats]
-                np.copyto(dst_arr, data, where = np.isnan(dst_arr) * ~np.isnan(data))
-                final_data[:, lons, lats] = dst_arr
-                
         return final_data
 
     def __max(dst, raster_paths, n_bands, width, height, dtype = np.float32, band_index = None):
@@ -1474,19 +1930,17 @@ def mosaic(input_dir, output_dir, output_name, method = 'mean', dtype = np.float
             ndarray: resulting merge
         """
 
-        final_data = np.empty(shape = (n_bands, height, width), dtype = dtype)
-        final_data[:] = np.NaN
+        final_data = __allocate(shape = (n_bands, height, width), dtype = dtype, fill_value = np.nan)
 
-        for raster_path in tqdm(raster_paths):
-            with rasterio.open(raster_path, 'r') as src:
-                data = src.read() if band_index is None else np.array([src.read(band_index)])
+        for data, lons, lats in __read_rasters(dst, raster_paths, band_index):
+
+            # np.fmax ignores NaN like np.nanmax, but works in place without stacking a temporary
+            dst_data = final_data[:, lons, lats]
+            np.fmax(dst_data, data, out = dst_data)
+            final_data[:, lons, lats] = dst_data
 
-                lons, lats = __latlon_to_index(dst, src)
-                
-                final_data[:, lons, lats] = np.nanmax([data, final_data[:, lons, lats]], axis = 0)
-                
         return final_data
-    
+
     def __min(dst, raster_paths, n_bands, width, height, dtype = np.float32, band_index = None):
         """
         Merge method that calculates the min value in those positions where more than one raster write its values.
@@ -1504,17 +1958,15 @@ def mosaic(input_dir, output_dir, output_name, method = 'mean', dtype = np.float
             ndarray: resulting merge
         """
 
-        final_data = np.empty(shape = (n_bands, height, width), dtype = dtype)
-        final_data[:] = np.NaN
+        final_data = __allocate(shape = (n_bands, height, width), dtype = dtype, fill_value = np.nan)
 
-        for raster_path in tqdm(raster_paths):
-            with rasterio.open(raster_path, 'r') as src:
-                data = src.read() if band_index is None else np.array([src.read(band_index)])
+        for data, lons, lats in __read_rasters(dst, raster_paths, band_index):
+
+            # np.fmin ignores NaN like np.nanmin, but works in place without stacking a temporary
+            dst_data = final_data[:, lons, lats]
+            np.fmin(dst_data, data, out = dst_data)
+            final_data[:, lons, lats] = dst_data
 
-                lons, lats = __latlon_to_index(dst, src)
-                
-                final_data[:, lons, lats] = np.nanmin([data, final_data[:, lons, lats]], axis = 0)
-                
         return final_data
 
 
@@ -1532,6 +1984,9 @@ def mosaic(input_dir, output_dir, output_name, method = 'mean', dtype = np.float
     with rasterio.open(raster_paths[0], 'r') as raster:
         n_bands = raster.count
         profile = raster.profile
+        # tiled + compressed output lets GDAL compress the blocks with all cores
+        _tiled_profile(profile)
+        profile['BIGTIFF'] = 'IF_SAFER'
         if len(raster_paths) > 1:
             width, height, transform = __get_merge_transform(raster_paths)
             profile['width'] = width
@@ -1540,18 +1995,32 @@ def mosaic(input_dir, output_dir, output_name, method = 'mean', dtype = np.float
         else:
             width, height = raster.width, raster.height
 
-    if band_names is not None and n_bands == len(band_names):
-        profile['count'] = 1
-        
-        with rasterio.open(output_name.replace('.', f'_band_{band_names[0]}.'), 'w', **profile) as dst:
-            data = method(dst, raster_paths, n_bands, width, height, dtype)
-
-        for band_index in range(n_bands):
-            with rasterio.open( output_name.replace('.', f'_band_{band_names[band_index]}.'), 'w', **profile) as dst:
-                dst.write( np.array([data[band_index]]) )
-    else:
-        with rasterio.open(output_name, 'w', **profile) as dst:
-            dst.write( method(dst, raster_paths, n_bands, width, height, dtype) )
+    # merge arrays live in temporary files that are removed once the mosaic is written
+    scratch_path = tempfile.mkdtemp(dir = scratch_dir)
+    data = None
+
+    try:
+        with rasterio.Env(GDAL_NUM_THREADS = 'ALL_CPUS'):
+            if band_names is not None and n_bands == len(band_names):
+                profile['count'] = 1
+                band_paths = [f'{os.path.splitext(output_name)[0]}_band_{band_name}.tif' for band_name in band_names]
+
+                # the first band file doubles as the destination of the merge
+                with rasterio.open(band_paths[0], 'w', **profile) as dst:
+                    data = method(dst, raster_paths, n_bands, width, height, dtype)
+                    __write(dst, data[0 : 1])
+
+                for band_index in range(1, n_bands):
+                    with rasterio.open(band_paths[band_index], 'w', **profile) as dst:
+                        __write(dst, data[band_index : band_index + 1])
+            else:
+                with rasterio.open(output_name, 'w', **profile) as dst:
+                    data = method(dst, raster_paths, n_bands, width, height, dtype)
+                    __write(dst, data)
+    finally:
+        # drop the last reference to the merge memmap so its file is closed before the folder is removed, which Windows requires
+        del data
+        shutil.rmtree(scratch_path, ignore_errors = True)
             
     
         
@@ -1561,9 +2030,55 @@ def mosaic(input_dir, output_dir, output_name, method = 'mean', dtype = np.float
 
 ### START Downsample ###
 
+def downsample_raster(raster_path, output_dir, scale_x, scale_y, method = Resampling.average, num_threads = 'ALL_CPUS'):
+    """
+    This function downsamples a single raster. It is used by downsample() on every file of the input directory.
+
+    Inputs:
+    raster_path: A string containing the filepath of the raster to downsample
+    output_dir: A string containing output directory filepath
+    scale_x: proportion by which the width of the file will be resized
+    scale_y: proportion by which the height of the file will be resized
+    method: the resampling method to perform. Defaults to Resampling.average.
+    num_threads: Number of threads GDAL uses to read and write the raster. Default is 'ALL_CPUS'. Callers running several rasters at once split the cores among them.
+
+    Output: A string containing the filepath of the downsampled raster
+    """
+
+    raster_name = os.path.basename(raster_path)
+    out_name = os.path.join(output_dir, f'{raster_name.split(".")[0]}__x_{scale_x}__y_{scale_y}__method_{method.name}.tif')
+
+    with rasterio.Env(GDAL_NUM_THREADS = num_threads), rasterio.open(raster_path, 'r', sharing = False) as dataset:
+        new_height, new_width = dataset.height // scale_x, dataset.width // scale_y
+
+        data = dataset.read(
+            out_shape = (dataset.count, new_height, new_width),
+            resampling = method
+        )
+
+        # the exact pixel ratio is used, since the sizes are floored when they are not divisible by the scale
+        dst_transform : Affine = dataset.transform * Affine.scale(dataset.width / new_width, dataset.height / new_height)
+
+        dst_kwargs = dataset.meta.copy()
+        dst_kwargs.update(
+            {
+                "crs": dataset.crs,
+                "transform": dst_transform,
+                "width": new_width,
+                "height": new_height,
+            }
+        )
+        # tiled + compressed output lets GDAL compress the blocks with num_threads
+        _tiled_profile(dst_kwargs, num_threads)
+
+        with rasterio.open(out_name, "w", **dst_kwargs) as dst:
+            dst.write(data)
+
+    return out_name
+
 def downsample(input_dir, output_dir, scale_x, scale_y, method = Resampling.average):
     """
-    This function performs a downsampling to reduce the spatial resolution of the final mosaic. 
+    This function performs a downsampling to reduce the spatial resolution of the final mosaic. Files are downsampled in parallel on a pool of threads, since GDAL releases the GIL while it resamples.
     
     Inputs:
     input_dir: A string containing input directory filepath  
@@ -1576,36 +2091,7 @@ def downsample(input_dir, output_dir, scale_x, scale_y, method = Resampling.aver
     os.makedirs(output_dir, exist_ok = True)
     raster_paths = glob.glob(os.path.join(input_dir, '*'))
 
-    for raster_path in tqdm(raster_paths):
-        raster_name = os.path.basename(raster_path)
-        out_name = os.path.join(output_dir, f'{raster_name.split(".")[0]}__x_{scale_x}__y_{scale_y}__method_{method.name}.tif')
-
-        with rasterio.open(raster_path, 'r') as dataset:
-            data = dataset.read(
-                out_shape = (
-                    dataset.count,
-                    dataset.height // scale_x,
-                    dataset.width // scale_y
-                ),
-                resampling = method
-            )
-            
-            dst_transform : Affine = dataset.transform * dataset.transform.scale(
-                (dataset.width / data.shape[-1]),
-                (dataset.height / data.shape[-2])
-            )
-            
-            dst_kwargs = dataset.meta.copy()
-            dst_kwargs.update(
-                {
-                    "crs": dataset.crs,
-                    "transform": dst_transform,
-                    "width": data.shape[-1],
-                    "height": data.shape[-2],
-                }
-            )
-            
-            with rasterio.open(out_name, "w", **dst_kwargs) as dst:
-                dst.write(data)
+    downsample_one = functools.partial(downsample_raster, output_dir = output_dir, scale_x = scale_x, scale_y = scale_y, method = method)
+    list(_map_images(downsample_one, raster_paths))
 
 ### END Downsample ###